@@ -1,21 +1,80 @@
 import sys
+import json
 import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import os
 import time
 import datetime
 import threading
 import sqlite3
-from typing import List, Dict, Any
+import queue
+from functools import lru_cache
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from typing import List, Dict, Any, Iterator, Optional, Tuple
+
+try:
+    from watchdog.observers import Observer
+    from watchdog.events import FileSystemEventHandler
+except ImportError:  # Fall back to polling when watchdog is not installed
+    Observer = None
+    FileSystemEventHandler = object
+
+try:
+    import orjson
+    dumps = orjson.dumps
+except ImportError:  # Fall back to the stdlib encoder when orjson is not installed
+    def dumps(obj: Any) -> bytes:
+        return json.dumps(obj, ensure_ascii=False).encode("utf-8")
 
 # Get Emby URL and API key from environment variables, or use defaults
 emby_url = os.environ.get('EMBY_URL', 'http://10.5.0.5:8096').strip()
 emby_api_key = os.environ.get('EMBY_API_KEY', 'ssss').strip()
 monitor_database = os.environ.get('DATABASE_FILE', '/app/db/emby_monitor.db').strip()
+# Opt-in: keep every known file in memory and diff scans against it. Memory then grows with the
+# library size (plus a set of the paths seen by each scan); by default scans stream through SQLite
+memory_cache = os.environ.get('MEMORY_CACHE', '0').strip().lower() in ('1', 'true', 'yes')
+EMBY_TIMEOUT = 10  # seconds - timeout for Emby API requests
 MONITOR_INTERVAL = 60  # seconds - how often to check for new files
-
-# Global database connection and lock
-db_conn: sqlite3.Connection = None
-db_lock = threading.Lock()
+RECONCILE_INTERVAL = 3600  # seconds - interval between full rescans that stat every file
+EVENT_SETTLE_DELAY = 5  # seconds - wait for file events to go quiet before processing them
+NOTIFY_WORKERS = 8  # concurrent Emby update requests per process
+EMBY_PROBE_INTERVAL = 300  # seconds - how long a successful reachability check stays valid
+EMBY_UPDATE_BATCH = 200  # items per Emby "Updates" request
+POPULATE_BATCH_SIZE = 5000  # rows per transaction when populating an empty table
+SCAN_BATCH_SIZE = 1000  # scanned rows buffered before they are written to the scan TEMP table
+
+# Raw keep-alive pool for the hot update POSTs, skipping requests' per-call overhead
+HTTP = urllib3.PoolManager(num_pools=1, maxsize=16,
+                           headers={"X-Emby-Token": emby_api_key, "Content-Type": "application/json"},
+                           timeout=urllib3.Timeout(total=EMBY_TIMEOUT),
+                           retries=Retry(total=2, backoff_factor=0.3))
+
+# Shared HTTP session for the occasional reachability probe
+SESSION = requests.Session()
+SESSION.headers.update({"X-Emby-Token": emby_api_key})
+SESSION.mount(emby_url, HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                    max_retries=Retry(total=2, backoff_factor=0.3)))
+
+# Thread pool for Emby notifications, shared by all monitor threads
+NOTIFY_POOL = ThreadPoolExecutor(max_workers=NOTIFY_WORKERS)
+
+# Timestamp of the last successful Emby reachability check
+_last_probe_ts: Optional[float] = None
+_probe_lock = threading.Lock()
+
+# inotify watches reserved by each watched root; max_user_watches is shared by all of them
+_inotify_reserved: Dict[str, int] = {}
+_inotify_lock = threading.Lock()
+
+# Per-thread read connections; all writes go through a single writer thread
+_tls = threading.local()
+db_write_queue: queue.Queue = queue.Queue()
+
+# In-memory copy of the files table, {directory: {path: last_modified}}; the database only
+# persists it. A directory is only ever touched by its own monitor thread once loaded.
+KNOWN: Dict[str, Dict[str, float]] = {}
 
 # Define the set of allowed file extensions (lowercase, no leading dot)
 ALLOWED_EXTENSIONS = {
@@ -27,6 +86,8 @@ ALLOWED_EXTENSIONS = {
     # Strm
     "strm"
 }
+# Immutable lookup set used on the per-file scan path
+ALLOWED_EXTS = frozenset(ALLOWED_EXTENSIONS)
 
 
 def log(message: str) -> None:
@@ -34,37 +95,56 @@ def log(message: str) -> None:
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     print(f"[{timestamp}] {message}", flush=True)  # Add flush=True
 
-def create_item(item_path: str, update_type: str) -> None:
-    """Sends a request to Emby to update the library with the given item."""
+def post_updates(updates: List[Tuple[str, str]]) -> None:
+    """Sends a single request to Emby to update the library with the given (path, update_type) pairs."""
     url = f"{emby_url}/emby/Library/Media/Updated"
-    payload = {"Updates": [{"Path": item_path, "UpdateType": update_type}]}
-    headers = {"X-Emby-Token": emby_api_key}
+    payload = {"Updates": [{"Path": item_path, "UpdateType": update_type} for item_path, update_type in updates]}
     try:
-        log(f"向 Emby 发送更新请求，路径：{item_path}，类型：{update_type}")
-        response = requests.post(url, json=payload, headers=headers)
-        response.raise_for_status()
-        if response.status_code == 204:
-            log(f"Item '{item_path}' {update_type.lower()} successfully.")
+        log(f"向 Emby 发送更新请求，共 {len(updates)} 个项目，首个路径：{updates[0][0]}")
+        response = HTTP.request("POST", url, body=dumps(payload))
+        if response.status == 204:
+            log(f"{len(updates)} items updated successfully.")
         else:
-            log(f"Unexpected status code {response.status_code} for item '{item_path}'. Status code: {response.status_code}")
-    except requests.exceptions.RequestException as e:
-        log(f"Error occurred while updating item '{item_path}': {e}")
+            log(f"Unexpected status code {response.status} for {len(updates)} items. Status code: {response.status}")
+    except urllib3.exceptions.HTTPError as e:
+        log(f"Error occurred while updating {len(updates)} items: {e}")
     except Exception as e:
         log(f"发生未知的错误：{e}")
 
-def process_item_library(item_path: str) -> None:
-    """Checks if the given item path is within an Emby library and triggers an update."""
-    log(f"处理媒体库项目：{item_path}")
-    url = f"{emby_url}/emby/Library/SelectableMediaFolders?api_key={emby_api_key}"
+def create_items(pairs: List[Tuple[str, str]]) -> List[Future]:
+    """Queues Emby library updates for (path, update_type) pairs, EMBY_UPDATE_BATCH items per request."""
+    # Chunks are posted concurrently over the keep-alive pool
+    return [NOTIFY_POOL.submit(post_updates, pairs[i:i + EMBY_UPDATE_BATCH])
+            for i in range(0, len(pairs), EMBY_UPDATE_BATCH)]
+
+def emby_reachable() -> bool:
+    """Checks that the Emby API is reachable, probing at most once every EMBY_PROBE_INTERVAL seconds."""
+    global _last_probe_ts
+    with _probe_lock:
+        if _last_probe_ts is not None and time.monotonic() - _last_probe_ts < EMBY_PROBE_INTERVAL:
+            return True
+        url = f"{emby_url}/emby/Library/SelectableMediaFolders"
+        try:
+            response = SESSION.get(url, timeout=EMBY_TIMEOUT)
+            response.raise_for_status()
+        except requests.exceptions.RequestException as e:
+            log(f"无法连接 Emby：{e}")
+            return False
+        _last_probe_ts = time.monotonic()
+        return True
+
+def process_items_library(pairs: List[Tuple[str, str]]) -> List[Future]:
+    """Checks that Emby is reachable and queues updates for the given (path, update_type) pairs."""
+    if not pairs: return []
+    log(f"处理媒体库项目：{len(pairs)} 个")
     try:
         # Simplified logic: Assume any valid media file should trigger an update.
         # The check against library folders can be complex and might not be necessary
         # if the monitored directories are already part of Emby libraries.
         # Emby will handle updates more intelligently if the path is known.
-        response = requests.get(url) # Still check if API is reachable
-        response.raise_for_status()
-        create_item(item_path, "Created") # Send update for the specific file path
-        return
+        if not emby_reachable(): # Still check if API is reachable (cached between probes)
+            return []
+        return create_items(pairs) # Send updates for the specific file paths
 
         # Original logic kept commented for reference:
         # response = requests.get(url)
@@ -87,9 +167,234 @@ def process_item_library(item_path: str) -> None:
         log(f"Error occurred while getting library information or sending update: {e}")
     except Exception as e:
         log(f"发生未知的错误：{e}")
+    return []
+
+def is_media_file(name: str) -> bool:
+    """Checks whether a file name has one of the allowed media extensions."""
+    _, dot, extension = name.rpartition('.')
+    return bool(dot) and extension.lower() in ALLOWED_EXTS
+
+def iter_media(directory: str,
+               known_dirs: Optional[Dict[str, int]] = None,
+               seen_dirs: Optional[Dict[str, int]] = None) -> Iterator[Tuple[str, Optional[float]]]:
+    """Recursively yields (path, last_modified) for media files under the directory using os.scandir.
+
+    When seen_dirs is given, the st_mtime_ns of every visited directory is recorded in it. Files in a
+    directory whose mtime matches known_dirs are yielded with last_modified None instead of being stat'ed.
+    """
+    unchanged = False
+    if seen_dirs is not None:
+        try:
+            mtime_ns = os.stat(directory).st_mtime_ns
+        except OSError as e:
+            log(f"访问文件夹时出错 {directory}: {e}")
+            return
+        seen_dirs[directory] = mtime_ns
+        # Adding, removing or renaming an entry bumps the directory mtime; in-place rewrites do not
+        unchanged = known_dirs is not None and known_dirs.get(directory) == mtime_ns
+    try:
+        with os.scandir(directory) as it:
+            entries = list(it)
+    except OSError as e:
+        log(f"访问文件夹时出错 {directory}: {e}")
+        return
+    for entry in entries:
+        try:
+            # Like os.walk, do not descend into symlinked directories
+            if entry.is_dir(follow_symlinks=False):
+                yield from iter_media(entry.path, known_dirs, seen_dirs)
+                continue
+            # Check extension first to avoid an unnecessary stat
+            if is_media_file(entry.name):
+                if unchanged:
+                    yield entry.path, None
+                else:
+                    # DirEntry caches the stat result; follows symlinks like os.path.getmtime did
+                    yield entry.path, entry.stat().st_mtime
+            # else: # Optional: log skipped files (can be noisy)
+            #     log(f"Skipping non-media file: {entry.path}")
+        except FileNotFoundError:
+            log(f"扫描时文件已消失：{entry.path}")
+            continue # Skip this file if it disappeared during scan
+        except OSError as e:
+            log(f"访问文件时出错 {entry.path}: {e}")
+            continue # Skip problematic files (e.g., permission errors)
+
+def iter_media_batches(directory: str,
+                       known_dirs: Optional[Dict[str, int]] = None,
+                       seen_dirs: Optional[Dict[str, int]] = None,
+                       size: int = SCAN_BATCH_SIZE) -> Iterator[List[Tuple[str, Optional[float]]]]:
+    """Yields the results of iter_media in lists of at most size rows."""
+    batch = []
+    for row in iter_media(directory, known_dirs, seen_dirs):
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def count_directories(directory: str) -> int:
+    """Counts the directories (including the root) under the given directory."""
+    count = 0
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        count += 1
+        try:
+            with os.scandir(current) as it:
+                for entry in it:
+                    if entry.is_dir(follow_symlinks=False):
+                        pending.append(entry.path)
+        except OSError:
+            continue
+    return count
+
+def use_file_events(directory: str) -> bool:
+    """Checks whether the directory can be watched with inotify instead of polled, reserving its watches if so."""
+    if Observer is None:
+        log("未安装 watchdog，使用轮询模式。")
+        return False
+    try:
+        with open("/proc/sys/fs/inotify/max_user_watches") as f:
+            max_watches = int(f.read())
+    except (OSError, ValueError):
+        log("无法读取 inotify 监视数量上限，使用轮询模式。")
+        return False
+    # A recursive watch needs one inotify watch per directory
+    watches = count_directories(directory)
+    with _inotify_lock:
+        # The limit is per user, so roots watched earlier use up part of it
+        available = max_watches - sum(_inotify_reserved.values())
+        if watches > available:
+            log(f"目录 '{directory}' 需要 {watches} 个 inotify 监视，超过剩余可用的 {available} 个（上限 {max_watches}），使用轮询模式。")
+            return False
+        _inotify_reserved[directory] = watches
+    return True
+
+def release_inotify_watches(directory: str) -> None:
+    """Returns the inotify watches reserved for the directory by use_file_events."""
+    with _inotify_lock:
+        _inotify_reserved.pop(directory, None)
+
+class MediaEventHandler(FileSystemEventHandler):
+    """Forwards watchdog events for media files to a queue as (action, path) tuples."""
+
+    def __init__(self, events: queue.Queue) -> None:
+        super().__init__()
+        self.events = events
+
+    def on_created(self, event) -> None:
+        # Files moved in from outside the watch only produce a created event
+        if not event.is_directory and is_media_file(os.path.basename(event.src_path)):
+            self.events.put(("update", event.src_path))
+
+    def on_closed(self, event) -> None:
+        # Closed after writing (IN_CLOSE_WRITE)
+        if not event.is_directory and is_media_file(os.path.basename(event.src_path)):
+            self.events.put(("update", event.src_path))
+
+    def on_moved(self, event) -> None:
+        # Directory moves within the watch are also reported per file, so only files are handled
+        if event.is_directory:
+            return
+        if is_media_file(os.path.basename(event.src_path)):
+            self.events.put(("delete", event.src_path))
+        if is_media_file(os.path.basename(event.dest_path)):
+            self.events.put(("update", event.dest_path))
+
+    def on_deleted(self, event) -> None:
+        if event.is_directory:
+            # Directories moved out of the watch are not reported per file
+            self.events.put(("delete_tree", event.src_path))
+        elif is_media_file(os.path.basename(event.src_path)):
+            self.events.put(("delete", event.src_path))
+
+def configure_connection(conn: sqlite3.Connection, database: str) -> None:
+    """Applies performance pragmas to a freshly opened SQLite connection."""
+    cursor = conn.cursor()
+    # WAL lets readers and the writer proceed concurrently; it is not available for in-memory databases
+    if database != ":memory:" and not database.startswith("file::memory:"):
+        cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")  # Safe with WAL, one fsync per checkpoint instead of per commit
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA cache_size=-64000")  # ~64 MB page cache
+    cursor.execute("PRAGMA mmap_size=268435456")  # 256 MB memory-mapped I/O
+    cursor.execute("PRAGMA busy_timeout=30000")
+
+def get_db_conn() -> sqlite3.Connection:
+    """Returns the calling thread's SQLite connection, opening it on first use."""
+    conn = getattr(_tls, "conn", None)
+    if conn is None:
+        # Use a timeout to prevent blocking indefinitely if DB is locked; transactions are
+        # opened explicitly with BEGIN instead of implicitly before every INSERT/DELETE
+        conn = sqlite3.connect(monitor_database, timeout=10.0, isolation_level=None)
+        configure_connection(conn, monitor_database)
+        _tls.conn = conn
+    return conn
+
+def close_db_conn() -> None:
+    """Closes the calling thread's SQLite connection, if it has one."""
+    conn = getattr(_tls, "conn", None)
+    if conn is not None:
+        conn.close()
+        _tls.conn = None
+
+def db_writer() -> None:
+    """Applies queued (sql, params_seq) write jobs on the single writer connection; (None, event) jobs are flush markers."""
+    conn = get_db_conn()
+    while True:
+        jobs = [db_write_queue.get()]
+        # Drain everything already queued so a burst of writes shares one commit
+        while True:
+            try:
+                jobs.append(db_write_queue.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            try:
+                with conn:
+                    conn.execute("BEGIN IMMEDIATE")
+                    for sql, params_seq in jobs:
+                        if sql is not None:
+                            conn.executemany(sql, params_seq)
+            except sqlite3.Error as e:
+                log(f"批量写入数据库时发生错误：{e}，逐个重试。")
+                # Retry the jobs one by one so a single bad job doesn't drop the whole burst
+                for sql, params_seq in jobs:
+                    if sql is None:
+                        continue
+                    try:
+                        with conn:
+                            conn.execute("BEGIN IMMEDIATE")
+                            conn.executemany(sql, params_seq)
+                    except sqlite3.Error as e:
+                        log(f"写入数据库时发生错误：{e}")
+        except Exception as e:
+            log(f"写入数据库时发生未知错误：{e}")
+        finally:
+            for sql, params_seq in jobs:
+                if sql is None:
+                    params_seq.set()  # Flush marker: everything queued before it is committed
+                db_write_queue.task_done()
+
+def start_db_writer() -> None:
+    """Starts the thread that owns the database write connection."""
+    thread = threading.Thread(target=db_writer, name="db-writer")
+    thread.daemon = True
+    thread.start()
+
+def wait_for_db_writes() -> None:
+    """Blocks until every write queued before the call has been committed."""
+    # The single writer applies jobs in order, so once this marker is reached everything
+    # queued before it is in the database; unlike queue.join() it isn't held up by later writes
+    done = threading.Event()
+    db_write_queue.put((None, done))
+    done.wait()
 
+@lru_cache(maxsize=None)  # Only ever called with the handful of monitored directories
 def get_table_name(directory: str) -> str:
-    """Generates a safe table name from the directory path."""
+    """Generates the name of the legacy per-directory table for the directory path."""
     table_name = ''.join(c if c.isalnum() else '_' for c in directory)
     # Ensure the table name doesn't start with a digit if it happens
     if table_name and table_name[0].isdigit():
@@ -97,186 +402,355 @@ def get_table_name(directory: str) -> str:
     return f"table_{table_name}" if table_name else "table_default" # Add default case
 
 def initialize_database(directory: str) -> None:
-    """Initializes the SQLite database with a table for the given directory."""
-    table_name = get_table_name(directory)
-    if not table_name:
-        log(f"无法为目录 '{directory}' 生成有效的表名。")
-        return
+    """Initializes the shared files table and migrates the legacy table for the given directory, if any."""
+    legacy_table = get_table_name(directory)
     try:
-        with db_lock:
-            cursor = db_conn.cursor()
-            cursor.execute(f"""
-                CREATE TABLE IF NOT EXISTS `{table_name}` (
+        db_conn = get_db_conn()
+        with db_conn:
+            db_conn.execute("BEGIN IMMEDIATE")
+            # Both tables are keyed by path; WITHOUT ROWID makes the primary key index the table itself,
+            # so reading (path, value) pairs is a single B-tree scan instead of an index plus rowid lookup
+            db_conn.execute("""
+                CREATE TABLE IF NOT EXISTS files (
                     path TEXT PRIMARY KEY,
+                    directory TEXT NOT NULL,
                     last_modified REAL
-                )
+                ) WITHOUT ROWID
             """) # Use REAL for float timestamps
-            db_conn.commit()
-            log(f"数据库表 '{table_name}' 初始化完成。")
+            # Serves both per-directory lookups and last_modified range filters within a directory,
+            # so it replaces the older directory-only index
+            db_conn.execute("CREATE INDEX IF NOT EXISTS idx_files_mtime ON files(directory, last_modified)")
+            db_conn.execute("DROP INDEX IF EXISTS idx_files_dir")
+            # Directory mtimes from the last scan, used to skip stat'ing files in unchanged directories
+            db_conn.execute("""
+                CREATE TABLE IF NOT EXISTS dirs (
+                    path TEXT PRIMARY KEY,
+                    mtime_ns INTEGER
+                ) WITHOUT ROWID
+            """)
+            # Older versions kept one table per monitored directory; carry its rows over
+            legacy = db_conn.execute(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?", (legacy_table,)
+            ).fetchone()
+            if legacy:
+                db_conn.execute(
+                    f"INSERT OR REPLACE INTO files (path, directory, last_modified) "
+                    f"SELECT path, ?, last_modified FROM `{legacy_table}`", (directory,)
+                )
+                db_conn.execute(f"DROP TABLE `{legacy_table}`")
+                log(f"已将旧数据库表 '{legacy_table}' 迁移到 'files'。")
+        log(f"目录 '{directory}' 的数据库初始化完成。")
     except sqlite3.Error as e:
-        log(f"数据库表 '{table_name}' 初始化失败：{e}")
+        log(f"目录 '{directory}' 的数据库初始化失败：{e}")
     except Exception as e:
-        log(f"数据库表 '{table_name}' 初始化时发生未知错误：{e}")
+        log(f"目录 '{directory}' 的数据库初始化时发生未知错误：{e}")
+
+def analyze_database() -> None:
+    """Refreshes the query planner statistics for the files and dirs tables."""
+    try:
+        get_db_conn().execute("ANALYZE")
+        log("数据库统计信息已更新。")
+    except sqlite3.Error as e:
+        log(f"更新数据库统计信息时发生错误：{e}")
 
 def is_table_empty(directory: str) -> bool:
-    """Checks if the table for the given directory is empty."""
-    table_name = get_table_name(directory)
-    if not table_name: return True # Assume empty if table name is invalid
+    """Checks if the database has no files recorded for the given directory."""
     try:
-        with db_lock:
-            cursor = db_conn.cursor()
-            cursor.execute(f"SELECT COUNT(*) FROM `{table_name}`")
-            count = cursor.fetchone()[0]
-            return count == 0
+        cursor = get_db_conn().cursor()
+        # EXISTS stops at the first matching index entry instead of counting them all
+        cursor.execute("SELECT EXISTS(SELECT 1 FROM files WHERE directory = ?)", (directory,))
+        return cursor.fetchone()[0] == 0
     except sqlite3.Error as e:
-        log(f"检查数据库表 '{table_name}' 是否为空时发生错误：{e}")
+        log(f"检查目录 '{directory}' 的数据库记录是否为空时发生错误：{e}")
         return True  # Assume it's empty in case of an error
     except Exception as e:
-        log(f"检查数据库表 '{table_name}' 时发生未知错误：{e}")
+        log(f"检查目录 '{directory}' 的数据库记录时发生未知错误：{e}")
         return True
 
+def load_known_files(directory: str) -> None:
+    """Loads the recorded files of the given directory into KNOWN, if the memory cache is enabled."""
+    if not memory_cache: return
+    try:
+        cursor = get_db_conn().cursor()
+        cursor.execute("SELECT path, last_modified FROM files WHERE directory = ?", (directory,))
+        KNOWN[directory] = dict(cursor)
+        log(f"已将目录 '{directory}' 的 {len(KNOWN[directory])} 条文件记录载入内存。")
+    except sqlite3.Error as e:
+        log(f"载入目录 '{directory}' 的文件记录时发生错误：{e}，改用数据库比对。")
+
 def file_exists_in_db(path: str, directory: str) -> bool:
-    """Checks if a file path exists in the database table for the given directory."""
-    table_name = get_table_name(directory)
-    if not table_name: return False # Assume not exists if table name is invalid
+    """Checks if a file path exists in the database for the given directory."""
+    known = KNOWN.get(directory)
+    if known is not None:
+        return path in known
     try:
-        with db_lock:
-            cursor = db_conn.cursor()
-            cursor.execute(f"SELECT 1 FROM `{table_name}` WHERE path = ?", (path,))
-            return cursor.fetchone() is not None
+        cursor = get_db_conn().cursor()
+        cursor.execute("SELECT EXISTS(SELECT 1 FROM files WHERE path = ? AND directory = ? LIMIT 1)", (path, directory))
+        return cursor.fetchone()[0] == 1
     except sqlite3.Error as e:
-        log(f"检查文件是否存在于数据库表 '{table_name}' 时发生错误：{e}")
+        log(f"检查文件是否存在于目录 '{directory}' 的数据库记录时发生错误：{e}")
         return False
     except Exception as e:
-        log(f"检查文件 '{path}' 在数据库表 '{table_name}' 时发生未知错误：{e}")
+        log(f"检查文件 '{path}' 在目录 '{directory}' 的数据库记录时发生未知错误：{e}")
         return False
 
 
-def add_file_to_db(path: str, last_modified: float, directory: str) -> None:
-    """Adds a file path and its last modified timestamp to the database table for the given directory."""
-    table_name = get_table_name(directory)
-    if not table_name: return # Skip if table name is invalid
-    try:
-        with db_lock:
-            cursor = db_conn.cursor()
-            # Use REAL for last_modified
-            cursor.execute(f"INSERT OR REPLACE INTO `{table_name}` (path, last_modified) VALUES (?, ?)", (path, last_modified))
-            db_conn.commit()
-            # Reduce log noise - maybe remove this log or make it conditional
-            # log(f"添加/更新文件到数据库表 '{table_name}'：{path}")
-    except sqlite3.Error as e:
-        log(f"添加文件到数据库表 '{table_name}' 时发生错误：{e}")
-    except Exception as e:
-        log(f"添加文件 '{path}' 到数据库表 '{table_name}' 时发生未知错误：{e}")
+def add_files_to_db(rows: List[Tuple[str, float]], directory: str) -> None:
+    """Queues (path, last_modified) rows for the given directory to be written in a single transaction."""
+    if not rows: return
+    known = KNOWN.get(directory)
+    if known is not None:
+        known.update(rows)
+    db_write_queue.put((
+        "INSERT OR REPLACE INTO files (path, directory, last_modified) VALUES (?, ?, ?)",
+        [(path, directory, last_modified) for path, last_modified in rows]
+    ))
+    # Reduce log noise - maybe remove this log or make it conditional
+    # log(f"添加/更新 {len(rows)} 个文件到目录 '{directory}' 的数据库记录")
 
 
 def remove_file_from_db(path: str, directory: str) -> None:
-    """Removes a file path from the database table for the given directory."""
-    table_name = get_table_name(directory)
-    if not table_name: return # Skip if table name is invalid
+    """Queues removal of a file path from the database for the given directory."""
+    known = KNOWN.get(directory)
+    if known is not None:
+        known.pop(path, None)
+    db_write_queue.put(("DELETE FROM files WHERE path = ? AND directory = ?", [(path, directory)]))
+    log(f"从数据库中删除文件：{path}")
+
+
+def get_dir_mtimes(directory: str) -> Dict[str, int]:
+    """Returns the recorded st_mtime_ns of the given directory and every directory below it."""
+    prefix = directory.rstrip(os.sep) + os.sep
     try:
-        with db_lock:
-            cursor = db_conn.cursor()
-            cursor.execute(f"DELETE FROM `{table_name}` WHERE path = ?", (path,))
-            db_conn.commit()
-            log(f"从数据库表 '{table_name}' 中删除文件：{path}")
+        cursor = get_db_conn().cursor()
+        cursor.execute(
+            "SELECT path, mtime_ns FROM dirs WHERE path = ? OR (path >= ? AND path < ?)",
+            (directory, prefix, prefix[:-1] + chr(ord(os.sep) + 1))
+        )
+        return dict(cursor)
     except sqlite3.Error as e:
-        log(f"从数据库表 '{table_name}' 中删除文件时发生错误：{e}")
-    except Exception as e:
-        log(f"从数据库表 '{table_name}' 删除文件 '{path}' 时发生未知错误：{e}")
+        log(f"读取目录 '{directory}' 的文件夹修改时间时发生错误：{e}")
+        return {}
+
+
+def save_dir_mtimes(changed: Dict[str, int], removed: List[str]) -> None:
+    """Queues updated directory mtimes and removal of directories that no longer exist."""
+    if changed:
+        db_write_queue.put(("INSERT OR REPLACE INTO dirs (path, mtime_ns) VALUES (?, ?)", list(changed.items())))
+    if removed:
+        db_write_queue.put(("DELETE FROM dirs WHERE path = ?", [(path,) for path in removed]))
+
+
+def remove_tree_from_db(tree: str, directory: str) -> None:
+    """Queues removal of all file paths below a subdirectory from the database for the given directory."""
+    prefix = tree.rstrip(os.sep) + os.sep
+    known = KNOWN.get(directory)
+    if known is not None:
+        for path in [path for path in known if path.startswith(prefix)]:
+            del known[path]
+    # Range scan on the primary key: every path starting with the prefix
+    db_write_queue.put((
+        "DELETE FROM files WHERE directory = ? AND path >= ? AND path < ?",
+        [(directory, prefix, prefix[:-1] + chr(ord(os.sep) + 1))]
+    ))
+    log(f"从数据库中删除目录下的文件：{tree}")
 
 
 def monitor_directory(directory: str) -> None:
     """Recursively monitors a directory for new/modified media files and triggers Emby library updates, using a database."""
-    table_name = get_table_name(directory)
-    if not table_name:
-        log(f"无法监控目录 '{directory}'，因为无法生成有效的表名。")
-        return
-
-    def scan_and_process_directory() -> None:
+    def scan_and_process_directory(full: bool = False) -> None:
         try:
-            current_files_on_disk = set()
-            log(f"开始扫描目录 '{directory}'...") # Log start of scan
-
-            # Scan disk for current files and their modification times
-            files_to_check = {}
-            for root, _, files in os.walk(directory):
-                for file in files:
-                    full_path = os.path.join(root, file)
-                    try:
-                        # Check extension first to avoid unnecessary getmtime
-                        file_extension = os.path.splitext(full_path)[1][1:].lower()
-                        if file_extension in ALLOWED_EXTENSIONS:
-                            current_files_on_disk.add(full_path)
-                            # Get mod time only for potentially relevant files
-                            last_modified = os.path.getmtime(full_path)
-                            files_to_check[full_path] = last_modified
-                        # else: # Optional: log skipped files (can be noisy)
-                        #     log(f"Skipping non-media file: {full_path}")
-
-                    except FileNotFoundError:
-                        log(f"扫描时文件已消失：{full_path}")
-                        continue # Skip this file if it disappeared during scan
-                    except OSError as e:
-                        log(f"访问文件时出错 {full_path}: {e}")
-                        continue # Skip problematic files (e.g., permission errors)
-
-            log(f"目录 '{directory}' 扫描完成。找到 {len(current_files_on_disk)} 个媒体文件。")
-
-            # Get files currently tracked in the database for this directory
-            db_files_info = {}
+            log(f"开始{'完整' if full else ''}扫描目录 '{directory}'...") # Log start of scan
+            # Writes from earlier scans or events may still be queued; the diff below reads
+            # the database, so let them land first or their files would be reported again
+            wait_for_db_writes()
+
+            # Scan disk for current files and their modification times; unless this is a full
+            # scan, files in directories that have not changed since the last scan are not stat'ed
+            known_dirs = get_dir_mtimes(directory)
+            seen_dirs: Dict[str, int] = {}
+            notifications: List[Future] = []
+            count = 0
+            known = KNOWN.get(directory)
+            seen: set = set()
             try:
-                with db_lock:
-                    cursor = db_conn.cursor()
-                    # Retrieve path and last_modified time
-                    cursor.execute(f"SELECT path, last_modified FROM `{table_name}`")
-                    for row in cursor.fetchall():
-                        db_files_info[row[0]] = row[1]
+                cursor = get_db_conn().cursor()
+                if known is None:
+                    # TEMP tables live on this thread's own connection, so no other thread sees them
+                    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS scan (path TEXT PRIMARY KEY) WITHOUT ROWID")
+                    cursor.execute("CREATE TEMP TABLE IF NOT EXISTS batch (path TEXT PRIMARY KEY, mtime REAL) WITHOUT ROWID")
+                    cursor.execute("DELETE FROM temp.scan")
+
+                # Diff each batch against the known files as soon as it is walked, so notifications for
+                # early files go out while the rest of the tree is still being scanned
+                for batch in iter_media_batches(directory, None if full else known_dirs, seen_dirs):
+                    count += len(batch)
+                    # Files on disk but not known (new), or with a newer modified time (modified)
+                    if known is not None:
+                        seen.update(path for path, _ in batch)
+                        changes = [
+                            (path, mtime, path not in known) for path, mtime in batch
+                            if path not in known or (mtime is not None and mtime > known[path])
+                        ]
+                    else:
+                        cursor.execute("DELETE FROM temp.batch")
+                        cursor.executemany("INSERT OR REPLACE INTO temp.batch (path, mtime) VALUES (?, ?)", batch)
+                        cursor.execute("INSERT OR IGNORE INTO temp.scan (path) SELECT path FROM temp.batch")
+                        cursor.execute("""
+                            SELECT b.path, b.mtime, f.path IS NULL
+                            FROM temp.batch b LEFT JOIN files f ON f.path = b.path
+                            WHERE f.path IS NULL OR b.mtime > f.last_modified
+                        """)
+                        changes = cursor.fetchall()
+                    new_or_modified = []
+                    updates = []
+                    for file_path, current_last_modified, is_new in changes:
+                        if current_last_modified is None:
+                            # Unknown file in an unchanged directory (e.g. the directory was recorded but the file was not)
+                            try:
+                                current_last_modified = os.stat(file_path).st_mtime
+                            except OSError as e:
+                                log(f"访问文件时出错 {file_path}: {e}")
+                                continue
+                        if is_new:
+                            # File is on disk but not in DB -> New file
+                            log(f"新文件检测到: {file_path}")
+                            updates.append((file_path, "Created"))
+                        else:
+                            # File is on disk and in DB, but modified time is newer
+                            log(f"修改文件检测到: {file_path}")
+                            updates.append((file_path, "Modified"))
+                        new_or_modified.append((file_path, current_last_modified))
+                    # Trigger updates for the batch without waiting for them
+                    notifications.extend(process_items_library(updates))
+                    add_files_to_db(new_or_modified, directory)
+                log(f"目录 '{directory}' 扫描完成。找到 {count} 个媒体文件。")
+
+                # Files known but no longer on disk in this scan; only known once the walk is complete
+                if known is not None:
+                    deleted_files = [path for path in known if path not in seen]
+                else:
+                    cursor.execute("DELETE FROM temp.batch")
+                    cursor.execute("""
+                        SELECT f.path
+                        FROM files f LEFT JOIN temp.scan s ON s.path = f.path
+                        WHERE f.directory = ? AND s.path IS NULL
+                    """, (directory,))
+                    deleted_files = [row[0] for row in cursor.fetchall()]
+                    cursor.execute("DELETE FROM temp.scan")
             except sqlite3.Error as e:
-                 log(f"从数据库表 '{table_name}' 读取数据时出错: {e}")
+                 log(f"从数据库读取目录 '{directory}' 的数据时出错: {e}")
                  # Decide how to handle this - maybe retry later or skip this cycle?
                  return # Skip processing this cycle if DB read fails
 
-
-            # --- Process changes ---
-
-            # 1. Check for New or Modified files
-            for file_path, current_last_modified in files_to_check.items():
-                db_last_modified = db_files_info.get(file_path)
-
-                if db_last_modified is None:
-                    # File is on disk but not in DB -> New file
-                    log(f"新文件检测到: {file_path}")
-                    process_item_library(file_path)
-                    add_file_to_db(file_path, current_last_modified, directory)
-                # Compare modification times (use a small tolerance if needed)
-                elif current_last_modified > db_last_modified:
-                    # File is on disk and in DB, but modified time is newer
-                    log(f"修改文件检测到: {file_path}")
-                    process_item_library(file_path) # Trigger update for modification too
-                    add_file_to_db(file_path, current_last_modified, directory)
-
-            # 2. Check for Deleted files
-            # Files in DB but no longer on disk in this scan
-            db_paths = set(db_files_info.keys())
-            deleted_files = db_paths - current_files_on_disk
             for file_path in deleted_files:
                 log(f"删除文件检测到: {file_path}")
                 # Optional: Send a 'Deleted' update to Emby?
-                # create_item(file_path, "Deleted") # This might require API changes or testing
+                # create_items([(file_path, "Deleted")]) # This might require API changes or testing
                 remove_file_from_db(file_path, directory)
 
+            # Remember directory mtimes, queued after the file rows they vouch for
+            save_dir_mtimes(
+                {path: mtime_ns for path, mtime_ns in seen_dirs.items() if known_dirs.get(path) != mtime_ns},
+                [path for path in known_dirs if path not in seen_dirs]
+            )
+
+            wait(notifications)
+
         except Exception as e:
             log(f"扫描目录 '{directory}' 时发生未预料的错误：{e}")
 
+    def process_events(pending: Dict[str, str]) -> None:
+        try:
+            # Deletions first, so a path deleted and recreated ends up in the database
+            for file_path, action in pending.items():
+                if action == "delete":
+                    log(f"删除文件检测到: {file_path}")
+                    remove_file_from_db(file_path, directory)
+                elif action == "delete_tree":
+                    log(f"删除目录检测到: {file_path}")
+                    remove_tree_from_db(file_path, directory)
+            # Let queued writes land, including the deletions above and the rows of earlier
+            # batches, before deciding whether a file is new or modified
+            wait_for_db_writes()
+
+            new_or_modified = []
+            updates = []
+            for file_path, action in pending.items():
+                if action != "update":
+                    continue
+                try:
+                    current_last_modified = os.stat(file_path).st_mtime
+                except FileNotFoundError:
+                    continue # Gone again before the events settled
+                except OSError as e:
+                    log(f"访问文件时出错 {file_path}: {e}")
+                    continue
+                if file_exists_in_db(file_path, directory):
+                    log(f"修改文件检测到: {file_path}")
+                    updates.append((file_path, "Modified"))
+                else:
+                    log(f"新文件检测到: {file_path}")
+                    updates.append((file_path, "Created"))
+                new_or_modified.append((file_path, current_last_modified))
+            notifications = process_items_library(updates)
+            add_files_to_db(new_or_modified, directory)
+            wait(notifications)
+        except Exception as e:
+            log(f"处理目录 '{directory}' 的文件事件时发生未预料的错误：{e}")
+
+    def watch_directory() -> bool:
+        events: queue.Queue = queue.Queue()
+        observer = Observer()
+        try:
+            observer.schedule(MediaEventHandler(events), directory, recursive=True)
+            observer.start()
+        except OSError as e:
+            log(f"无法监视目录 '{directory}' 的文件事件：{e}，改用轮询模式。")
+            release_inotify_watches(directory)
+            return False
+
+        log(f"开始通过文件事件监控 '{directory}'，每 {RECONCILE_INTERVAL} 秒完整扫描一次...")
+        # Catch up on changes made while the monitor was not running
+        scan_and_process_directory(full=True)
+        next_reconcile = time.monotonic() + RECONCILE_INTERVAL
+        pending: Dict[str, str] = {}
+        first_event = last_event = 0.0
+        while True:
+            now = time.monotonic()
+            # Process once events go quiet, but never hold them longer than MONITOR_INTERVAL
+            if pending and (now - last_event >= EVENT_SETTLE_DELAY or now - first_event >= MONITOR_INTERVAL):
+                process_events(pending)
+                pending = {}
+            if now >= next_reconcile:
+                scan_and_process_directory(full=True)
+                next_reconcile = time.monotonic() + RECONCILE_INTERVAL
+            timeout = EVENT_SETTLE_DELAY if pending else max(0.0, next_reconcile - time.monotonic())
+            try:
+                action, file_path = events.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            if not pending:
+                first_event = time.monotonic()
+            last_event = time.monotonic()
+            pending[file_path] = action
+
+    if use_file_events(directory) and watch_directory():
+        return
+
     log(f"开始监控 '{directory}' 每 {MONITOR_INTERVAL} 秒...")
 
     # Initial delay before first scan can be useful
     # time.sleep(5)
 
+    # Skipping unchanged directories misses files rewritten in place, so rescan fully now and then
+    next_full_scan = time.monotonic()
     while True:
         log(f"开始扫描周期 '{directory}'...")
-        scan_and_process_directory()
+        full = time.monotonic() >= next_full_scan
+        scan_and_process_directory(full=full)
+        if full:
+            next_full_scan = time.monotonic() + RECONCILE_INTERVAL
         log(f"扫描周期 '{directory}' 完成，等待 {MONITOR_INTERVAL} 秒...")
         time.sleep(MONITOR_INTERVAL)
 
@@ -288,35 +762,28 @@ def monitor_directory_threaded(directory: str) -> None:
     thread.start()
 
 def populate_database(directory: str) -> None:
-    """Populates the database for the given directory if the table is empty."""
-    table_name = get_table_name(directory)
-    if not table_name: return # Skip if table name invalid
+    """Populates the database for the given directory if it has no recorded files yet."""
     if is_table_empty(directory):
-        log(f"数据库表 '{table_name}' 为空，开始填充数据库。")
+        log(f"目录 '{directory}' 在数据库中没有记录，开始填充数据库。")
         count = 0
+        rows = []
         try:
-            for root, _, files in os.walk(directory):
-                for file in files:
-                    full_path = os.path.join(root, file)
-                    try:
-                        # Only add files with allowed extensions during population
-                        file_extension = os.path.splitext(full_path)[1][1:].lower()
-                        if file_extension in ALLOWED_EXTENSIONS:
-                            last_modified = os.path.getmtime(full_path)
-                            add_file_to_db(full_path, last_modified, directory)
-                            count += 1
-                    except FileNotFoundError:
-                         log(f"填充数据库时文件不存在: {full_path}")
-                         continue # Skip if file disappears during population
-                    except OSError as e:
-                         log(f"填充数据库时访问文件出错 {full_path}: {e}")
-                         continue # Skip problematic files
-
-            log(f"数据库表 '{table_name}' 填充完毕，添加了 {count} 个文件。")
+            # Only files with allowed extensions are yielded during population
+            for full_path, last_modified in iter_media(directory):
+                rows.append((full_path, last_modified))
+                count += 1
+                if len(rows) >= POPULATE_BATCH_SIZE:
+                    add_files_to_db(rows, directory)
+                    rows = []
+
+            add_files_to_db(rows, directory)
+            # Monitor threads must see the populated rows before their first scan
+            wait_for_db_writes()
+            log(f"目录 '{directory}' 的数据库填充完毕，添加了 {count} 个文件。")
         except OSError as e:
             log(f"填充数据库时访问文件夹 {directory} 出现错误: {e}")
         except Exception as e:
-            log(f"填充数据库表 '{table_name}' 时发生未知错误: {e}")
+            log(f"填充目录 '{directory}' 的数据库时发生未知错误: {e}")
 
 if __name__ == "__main__":
     if len(sys.argv) < 2:
@@ -336,10 +803,11 @@ if __name__ == "__main__":
 
 
     try:
-        # Initialize global database connection
-        # Use a timeout to prevent blocking indefinitely if DB is locked
-        db_conn = sqlite3.connect(monitor_database, check_same_thread=False, timeout=10.0) # Increased timeout
+        # Open the main thread's connection; every thread gets its own, and WAL lets readers
+        # run alongside the single writer thread
+        get_db_conn()
         log(f"数据库连接成功：{monitor_database}")
+        start_db_writer()
 
         active_threads = []
         # Initialize database tables and populate them if empty
@@ -351,6 +819,7 @@ if __name__ == "__main__":
             log(f"正在初始化目录：{directory}")
             initialize_database(directory)
             populate_database(directory) # Populate only adds if empty
+            load_known_files(directory)
 
             # Start monitoring thread only for valid, initialized directories
             log(f"为目录启动监控线程: {directory}")
@@ -364,6 +833,10 @@ if __name__ == "__main__":
              log("没有有效的目录可监控，程序退出。")
              sys.exit(1)
 
+        # Rebuild planner statistics now that every directory has been populated
+        wait_for_db_writes()
+        analyze_database()
+
         log(f"开始监控 {len(active_threads)} 个目录...")
 
         # Keep the main thread alive, checking if monitor threads are alive
@@ -382,7 +855,6 @@ if __name__ == "__main__":
         log("收到中断信号，正在关闭...")
 
     finally:
-        if db_conn:
-            db_conn.close()
-            log("关闭数据库连接")
+        close_db_conn()
+        log("关闭数据库连接")
         log("程序退出。")
@@ -1,37 +1,142 @@
 from flask import Flask, request, abort
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 from os import environ
 import yaml
+try:
+    import orjson
+except ImportError:  # 未安装 orjson 时使用 Flask 自带的 JSON 解析
+    orjson = None
+import heapq
+import io
+from collections import OrderedDict
+import itertools
+import json
 import logging
+import os
+import queue
 import time
-from threading import Timer
+from concurrent.futures import ThreadPoolExecutor
+from threading import Condition, Lock, Thread
 
 app = Flask(__name__)
 
+# 优先使用 libyaml 的 C 解析器，不可用时退回纯 Python 实现
+Loader = getattr(yaml, "CSafeLoader", yaml.SafeLoader)
+
 # 配置日志
 #logging.basicConfig(level=logging.INFO,
 #                    format='%(asctime)s - %(levelname)s - %(message)s')
 #app.logger.setLevel(logging.INFO)
 
-# 消息缓存
-message_cache = {}
+# 消息缓存，"项目 ID:接收者 ID" -> (定时句柄, 消息数据)，超过上限时淘汰最早的条目
+MESSAGE_CACHE_MAX = 10_000
+message_cache = OrderedDict()
+_message_cache_lock = Lock()
 MESSAGE_DELAY = 5  # 等待 5 秒
 
+# 配置 REDIS_URL 时，延迟发送的状态保存在 Redis 中，重启后可以恢复，多个实例之间也能去重
+REDIS_URL = environ.get("REDIS_URL", "").strip()
+REDIS_PENDING_KEY = "emby:pending"  # 待发送消息的去重键，分数为到期时间
+REDIS_MESSAGE_TTL = 3600  # 秒，重启后仍能恢复待发送消息的时间
+redis_client = None
+if REDIS_URL:
+    try:
+        import redis
+        redis_client = redis.Redis.from_url(REDIS_URL, decode_responses=True)
+    except ImportError:
+        app.logger.error("REDIS_URL is set but the redis package is not installed, debouncing in process.")
+
+# 最近收到的媒体库事件，(事件, 项目 ID) -> 收到时间，用于丢弃 MESSAGE_DELAY 内的重复 webhook
+DEDUP_EVENTS = {"library.new", "library.deleted"}
+RECENT_EVENTS_MAX = 512
+_recent_events = OrderedDict()
+_recent_events_lock = Lock()
+
+# 海报图片缓存，项目 ID -> (图片, 过期时间)
+IMAGE_CACHE_TTL = 60  # 秒
+MAX_PHOTO_SIZE = 10 * 1024 * 1024  # Telegram sendPhoto 的大小上限，超过则只发文字
+_image_cache = {}
+_image_cache_lock = Lock()
+
+CONFIG_FILE = "/config/config.yaml"
+# 解析后的配置缓存，按配置文件的 mtime 失效
+_config_cache = {"mtime": None, "data": None, "token": None, "emby_server": None, "admin_ids": None}
+_config_lock = Lock()
+CONFIG_RELOAD_INTERVAL = 5  # 秒，后台检查配置文件是否修改的间隔
+
+# Telegram 限流 (429) 时按 Retry-After 重新调度发送的次数上限，及没有给出等待时间时的默认值
+TELEGRAM_MAX_RESCHEDULES = 3
+TELEGRAM_RETRY_DELAY = 5  # 秒
+
+# webhook 收到的事件放入有界队列，由工作线程处理，请求线程立即返回
+EVENT_QUEUE_SIZE = 1024
+EVENT_WORKERS = 8
+_event_queue = queue.Queue(maxsize=EVENT_QUEUE_SIZE)
+
+# Telegram Bot API 地址，token -> (sendPhoto, sendMessage)
+_telegram_urls = {}
+
+HTTP_TIMEOUT = (1.5, 8)  # (连接, 读取) 超时秒数，连接不上的服务尽快失败
+
+# 共享的 HTTP 会话，复用到 Telegram 和 Emby 的 keep-alive 连接。
+# 默认的 allowed_methods 不含 POST：Telegram 发送只在连接失败时重试，读超时和 5xx 不重发以免重复消息，
+# 429 由 handle_send_failure 交给调度线程延迟重发；获取海报的 GET 仍对 429/5xx 退避重试
+_session = requests.Session()
+_session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=32,
+                                       max_retries=Retry(total=3, backoff_factor=0.3,
+                                                         status_forcelist=[429, 500, 502, 503, 504],
+                                                         raise_on_status=False)))
+_session.mount("http://", _session.get_adapter("https://"))
+
+# 延迟消息由单个调度线程统一计时，到期后交给发送线程池，不再为每条消息创建 Timer 线程
+SEND_WORKERS = 4
+_schedule = []  # (到期时间, 序号, ScheduledCall) 小顶堆
+_schedule_seq = itertools.count()
+_schedule_cond = Condition()
+_send_pool = ThreadPoolExecutor(max_workers=SEND_WORKERS)
+
 
 def load_config():
     """加载配置信息."""
     try:
-        with open("/config/config.yaml", "r") as f:
-            config_data = yaml.safe_load(f)
+        with open(CONFIG_FILE, "r") as f:
+            config_data = yaml.load(f, Loader=Loader)
         return config_data
     except FileNotFoundError:
-        app.logger.error("Config file not found: /config/config.yaml")
+        app.logger.error(f"Config file not found: {CONFIG_FILE}")
         return None
     except yaml.YAMLError as e:
         app.logger.error(f"Error parsing config file: {e}")
         return None
 
 
+def get_cached_config():
+    """获取缓存的配置，配置文件修改后才重新解析."""
+    try:
+        mtime = os.stat(CONFIG_FILE).st_mtime
+    except OSError:
+        app.logger.error(f"Config file not found: {CONFIG_FILE}")
+        return None
+
+    global _config_cache
+    with _config_lock:
+        if _config_cache["mtime"] != mtime:
+            config = load_config()
+            if not config:
+                return None
+            # 整体替换而不是原地修改，读取方不会看到只更新了一半的配置
+            _config_cache = {
+                "mtime": mtime,
+                "data": config,
+                "token": get_telegram_token(config),
+                "emby_server": get_emby_url(config),
+                "admin_ids": get_ids(config, "admins"),
+            }
+        return _config_cache
+
+
 def get_telegram_token(config):
     """获取 Telegram Token."""
     try:
@@ -66,35 +171,57 @@ def get_ids(config, key):
         return None
 
 
+# 事件类型对应的图标
+_EVENT_ICONS = {
+    "playback.start": "▶ ",
+    "playback.stop": "⏹ ",
+    "playback.pause": "⏸ ",
+    "playback.unpause": "⏯ ",
+    "library.deleted": "🗑 ",
+    "item.markunplayed": "❎",
+    "item.markplayed": "✅",
+    "system.updateavailable": "💾",
+    "user.authenticationfailed": "🔒",
+    "user.authenticated": "🔐",
+    "system.serverrestartrequired": "🔄",
+    "plugins.pluginuninstalled": "📤",
+    "plugins.plugininstalled": "📥",
+}
+
+
+def refresh_config():
+    """重新加载已修改的配置并保存到 app.config["EMBY_CFG"]，加载失败时保留上一次的配置."""
+    config = get_cached_config()
+    if config:
+        app.config["EMBY_CFG"] = config
+
+
+def watch_config():
+    """后台线程：定期检查配置文件，请求处理时不再读取配置文件."""
+    while True:
+        time.sleep(CONFIG_RELOAD_INTERVAL)
+        refresh_config()
+
+
+# 启动时预加载配置
+app.config["EMBY_CFG"] = None
+refresh_config()
+_config_thread = Thread(target=watch_config, name="config-watcher", daemon=True)
+_config_thread.start()
+
+
 def get_icon(argument):
     """根据事件类型获取对应图标."""
-    icons = {
-        "playback.start": "▶ ",
-        "playback.stop": "⏹ ",
-        "playback.pause": "⏸ ",
-        "playback.unpause": "⏯ ",
-        "library.deleted": "🗑 ",
-        "item.markunplayed": "❎",
-        "item.markplayed": "✅",
-        "system.updateavailable": "💾",
-        "user.authenticationfailed": "🔒",
-        "user.authenticated": "🔐",
-        "system.serverrestartrequired": "🔄",
-        "plugins.pluginuninstalled": "📤",
-        "plugins.plugininstalled": "📥",
-    }
-    return icons.get(argument, "")
-
-
-def update(response, token, send_id):
+    return _EVENT_ICONS.get(argument, "")
+
+
+def update(response, token, send_id, event, icon):
     """处理 Emby 更新事件."""
     try:
         server_version = response["Server"]["Version"]
         new_version = response["PackageVersionInfo"]["versionStr"]
         info_url = response["PackageVersionInfo"]["infoUrl"]
         desc = response["PackageVersionInfo"]["description"]
-        event = response["Event"]
-        icon = get_icon(event)
         text = (
             f"{icon} Update from version {server_version} to {new_version} available"
             f"\nDescription: {desc}\nMore info: {info_url}"
@@ -106,24 +233,23 @@ def update(response, token, send_id):
         app.logger.error(f"Error processing update event: {e}")
 
 
-def marked(response, token, send_id):
+def marked(response, token, send_id, event, icon):
     """处理 Emby 标记已读/未读事件."""
     try:
-        event = response["Event"]
         item = response["Item"]
-        icon = get_icon(event)
         item_type = item["Type"]
+        action = "played" if event == "item.markplayed" else "unplayed"
 
         if item_type == "Movie":
             item_name = item["Name"]
-            text = f"{icon} Marked {'played' if 'markplayed' in event else 'unplayed'}: {item_name}"
+            text = f"{icon} Marked {action}: {item_name}"
         elif item_type == "Episode":
             series_name = item["SeriesName"]
             season_name = item["SeasonName"]
             episode_name = item["Name"]
             episode_number = item["IndexNumber"]
             text = (
-                f"{icon} Marked {'played' if 'markplayed' in event else 'unplayed'}:"
+                f"{icon} Marked {action}:"
                 f" {series_name} {season_name} episode {episode_number} - {episode_name}"
             )
         else:
@@ -137,12 +263,10 @@ def marked(response, token, send_id):
         app.logger.error(f"Error processing marked event: {e}")
 
 
-def send_message(response, token, send_id):
+def send_message(response, token, send_id, event, icon):
     """发送 Emby 事件消息."""
     try:
-        event = response["Event"]
         text = response["Title"]
-        icon = get_icon(event)
         message = icon + text
         send_telegram_message(token, send_id, message)
     except KeyError as e:
@@ -183,48 +307,15 @@ def lib_new(response, token, send_id, emby_server):
             send_telegram_message(token, send_id, text)
             return
 
-        photo_url = f"{emby_server}/emby/Items/{item_id}/Images/Primary"
-        files = None  # 初始化 files 变量
-        image_response = None  # 初始化 image_response
-
-        try:
-            image_response = requests.get(photo_url, timeout=5)  # 添加超时
-            image_response.raise_for_status()
-            photo = ("photo.jpg", image_response.content, "image/jpeg")
-            files = {"photo": photo}  # 赋值 files 变量
-            caption = f"{title}\n\nDescription: {desc}"
-            # send_telegram_message(token, send_id, None, photo=photo, caption=caption)
-            message_data = {
-                "token": token,
-                "send_id": send_id,
-                "text": None,
-                "photo": photo,
-                "caption": caption
-            }
-
-        except requests.exceptions.RequestException as e:
-            app.logger.error(f"Failed to get image from {photo_url}: {e}")
-            # text = f"{title}\n\nDescription: {desc}"
-            # send_telegram_message(token, send_id, text)
-            message_data = {
-                "token": token,
-                "send_id": send_id,
-                "text": f"{title}\n\nDescription: {desc}",
-                "photo": None,
-                "caption": None
-            }
-
-        except Exception as e:
-            app.logger.error(f"Failed to get image from {photo_url}: {e}")
-            # text = f"{title}\n\nDescription: {desc}"
-            # send_telegram_message(token, send_id, text)
-            message_data = {
-                "token": token,
-                "send_id": send_id,
-                "text": f"{title}\n\nDescription: {desc}",
-                "photo": None,
-                "caption": None
-            }
+        # 只记录发送所需的信息，海报在延迟结束真正发送时才获取
+        message_data = {
+            "token": token,
+            "send_id": send_id,
+            "emby_server": emby_server,
+            "item_id": item_id,
+            "title": title,
+            "desc": desc,
+        }
 
         # 延迟发送消息
         schedule_message(item_id, message_data)
@@ -235,143 +326,403 @@ def lib_new(response, token, send_id, emby_server):
         app.logger.error(f"Error processing lib_new event: {e}")
 
 
-def send_telegram_message(token, chat_id, text, photo=None, caption=None):
+def get_retry_after(response):
+    """读取 Telegram 429 响应中要求等待的秒数."""
+    try:
+        return int(response.headers["Retry-After"])
+    except (KeyError, ValueError):
+        pass
+    try:
+        return int(response.json()["parameters"]["retry_after"])
+    except (ValueError, KeyError, TypeError):
+        return TELEGRAM_RETRY_DELAY
+
+
+def handle_send_failure(response, token, chat_id, text, photo, caption, attempt):
+    """记录发送失败的响应；被限流时按 Retry-After 延迟重新发送."""
+    app.logger.warning(f"telegram {response.status_code}: {response.text[:200]}")
+    if response.status_code != 429 or attempt >= TELEGRAM_MAX_RESCHEDULES:
+        return
+    retry_after = get_retry_after(response)
+    app.logger.info(f"Rate limited sending to chat_id {chat_id}, retrying in {retry_after}s.")
+    call_later(retry_after, send_telegram_message, token, chat_id, text, photo, caption, attempt + 1)
+
+
+def send_telegram_message(token, chat_id, text, photo=None, caption=None, attempt=0):
     """发送 Telegram 消息."""
-    base_url = f"https://api.telegram.org/bot{token}"
+    urls = _telegram_urls.get(token)
+    if urls is None:
+        base_url = f"https://api.telegram.org/bot{token}"
+        urls = _telegram_urls.setdefault(token, (f"{base_url}/sendPhoto", f"{base_url}/sendMessage"))
     if photo:
-        url = f"{base_url}/sendPhoto"
+        url = urls[0]
         data = {
             "chat_id": chat_id,
             "caption": caption,
             "parse_mode": "Markdown",
         }
         try:
-            response = requests.post(url, data=data, files={"photo": photo}, timeout=10)  # 添加超时
-            response.raise_for_status()  # 检查 HTTP 状态码
+            response = _session.post(url, data=data, files={"photo": photo}, timeout=HTTP_TIMEOUT)
+            if response.status_code >= 400:  # 检查 HTTP 状态码
+                handle_send_failure(response, token, chat_id, text, photo, caption, attempt)
+                return
             log_message = f"Message sent to chat_id {chat_id}: {caption[:50]}..." if caption else f"Message sent to chat_id {chat_id}: (No Caption)"
             app.logger.info(log_message)  # 记录发送的消息 (截取前50个字符)
         except requests.exceptions.RequestException as e:
             app.logger.error(f"Failed to send message to chat_id {chat_id}: {e}")
 
     else:
-        url = f"{base_url}/sendMessage"
+        url = urls[1]
         data = {
             "chat_id": chat_id,
             "text": text,
             "parse_mode": "Markdown",
         }
         try:
-            response = requests.post(url, data=data, timeout=10)  # 添加超时
-            response.raise_for_status()  # 检查 HTTP 状态码
+            response = _session.post(url, data=data, timeout=HTTP_TIMEOUT)
+            if response.status_code >= 400:  # 检查 HTTP 状态码
+                handle_send_failure(response, token, chat_id, text, photo, caption, attempt)
+                return
             log_message = f"Message sent to chat_id {chat_id}: {text[:50]}..." if text else f"Message sent to chat_id {chat_id}: (No Text)"
             app.logger.info(log_message)  # 记录发送的消息 (截取前50个字符)
         except requests.exceptions.RequestException as e:
             app.logger.error(f"Failed to send message to chat_id {chat_id}: {e}")
 
+class ScheduledCall:
+    """可取消的延迟调用，接口与 threading.Timer 的 cancel() 一致."""
+
+    __slots__ = ("callback", "args", "cancelled")
+
+    def __init__(self, callback, args):
+        self.callback = callback
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+def call_later(delay, callback, *args):
+    """在 delay 秒后于发送线程池中执行 callback，返回可取消的句柄."""
+    handle = ScheduledCall(callback, args)
+    with _schedule_cond:
+        heapq.heappush(_schedule, (time.monotonic() + delay, next(_schedule_seq), handle))
+        _schedule_cond.notify()
+    return handle
+
+
+def run_scheduler():
+    """调度线程：等待最早到期的调用并提交到发送线程池."""
+    while True:
+        with _schedule_cond:
+            while True:
+                if not _schedule:
+                    _schedule_cond.wait()
+                    continue
+                timeout = _schedule[0][0] - time.monotonic()
+                if timeout <= 0:
+                    break
+                _schedule_cond.wait(timeout)
+            _, _, handle = heapq.heappop(_schedule)
+        if not handle.cancelled:
+            _send_pool.submit(run_scheduled, handle)
+
+
+def run_scheduled(handle):
+    """执行到期的调用，记录异常以免静默丢失."""
+    try:
+        handle.callback(*handle.args)
+    except Exception as e:
+        app.logger.error(f"Error running scheduled message: {e}")
+
+
+_scheduler_thread = Thread(target=run_scheduler, name="message-scheduler", daemon=True)
+_scheduler_thread.start()
+
+
+def message_key(item_id, send_id):
+    """延迟消息的去重键：同一项目发给不同接收者的消息互不覆盖."""
+    return f"{item_id}:{send_id}"
+
+
 def schedule_message(item_id, message_data):
     """延迟发送消息."""
-    if item_id in message_cache:
-        # 取消之前的定时器
-        message_cache[item_id].cancel()
+    key = message_key(item_id, message_data["send_id"])
+    if redis_client is not None:
+        try:
+            schedule_redis_message(key, message_data)
+            return
+        except redis.RedisError as e:
+            app.logger.error(f"Failed to schedule message in Redis, debouncing in process: {e}")
+
+    with _message_cache_lock:
+        previous = message_cache.pop(key, None)
+        if previous:
+            # 取消之前的定时器
+            previous[0].cancel()
+
+        # 创建新的定时器
+        handle = call_later(MESSAGE_DELAY, send_message_callback, key, message_data)
+        message_cache[key] = (handle, message_data)
+        if len(message_cache) > MESSAGE_CACHE_MAX:
+            # 被淘汰的消息照常发送，只是不能再被取消
+            message_cache.popitem(last=False)
+
+
+def schedule_redis_message(key, message_data):
+    """在 Redis 中记录延迟消息，MESSAGE_DELAY 内同一项目发给同一接收者的后续消息直接丢弃."""
+    if not redis_client.set(f"emby:debounce:{key}", "1", ex=MESSAGE_DELAY, nx=True):
+        app.logger.debug(f"Message {key} already pending, skipping.")
+        return
+    pipe = redis_client.pipeline()
+    pipe.set(f"emby:msg:{key}", json.dumps(message_data), ex=MESSAGE_DELAY + REDIS_MESSAGE_TTL)
+    pipe.zadd(REDIS_PENDING_KEY, {key: time.time() + MESSAGE_DELAY})
+    pipe.execute()
+    call_later(MESSAGE_DELAY, send_redis_message, key)
+
+
+def fetch_poster(emby_server, item_id):
+    """获取项目的海报图片，IMAGE_CACHE_TTL 秒内复用已获取的图片."""
+    now = time.monotonic()
+    with _image_cache_lock:
+        cached = _image_cache.get(item_id)
+        if cached and cached[1] > now:
+            return cached[0]
+
+    photo_url = f"{emby_server}/emby/Items/{item_id}/Images/Primary"
+    try:
+        # 流式读取，超过上限立即放弃，避免大图占用内存后再被 Telegram 拒绝
+        with _session.get(photo_url, timeout=HTTP_TIMEOUT, stream=True) as image_response:
+            image_response.raise_for_status()
+            buf = io.BytesIO()
+            for chunk in image_response.iter_content(65536):
+                buf.write(chunk)
+                if buf.tell() > MAX_PHOTO_SIZE:
+                    app.logger.warning(f"Image from {photo_url} exceeds {MAX_PHOTO_SIZE} bytes, sending text only.")
+                    return None
+    except requests.exceptions.RequestException as e:
+        app.logger.error(f"Failed to get image from {photo_url}: {e}")
+        return None
 
-    # 创建新的定时器
-    timer = Timer(MESSAGE_DELAY, send_message_callback, args=[item_id, message_data])
-    message_cache[item_id] = timer
-    timer.start()
+    photo = ("photo.jpg", buf.getvalue(), "image/jpeg")
+    with _image_cache_lock:
+        # 顺便清理过期的图片
+        for key in [key for key, (_, expiry) in _image_cache.items() if expiry <= now]:
+            del _image_cache[key]
+        _image_cache[item_id] = (photo, now + IMAGE_CACHE_TTL)
+    return photo
 
 
-def send_message_callback(item_id, message_data):
-    """发送消息的回调函数."""
+def deliver_message(item_id, message_data):
+    """发送延迟的媒体库新增消息，能获取海报时附带海报."""
     token = message_data["token"]
     send_id = message_data["send_id"]
-    text = message_data["text"]
-    photo = message_data["photo"]
-    caption = message_data["caption"]
+    text = f"{message_data['title']}\n\nDescription: {message_data['desc']}"
+
+    photo = fetch_poster(message_data["emby_server"], item_id)
+    if photo:
+        send_telegram_message(token, send_id, None, photo, text)
+    else:
+        send_telegram_message(token, send_id, text)
+
+
+def send_message_callback(key, message_data):
+    """发送消息的回调函数."""
+    deliver_message(message_data["item_id"], message_data)
+
+    # 从缓存中删除消息，已被更新的消息替换时保留新的条目
+    with _message_cache_lock:
+        entry = message_cache.get(key)
+        if entry and entry[1] is message_data:
+            del message_cache[key]
 
-    send_telegram_message(token, send_id, text, photo, caption)
 
-    # 从缓存中删除消息
-    del message_cache[item_id]
+def send_redis_message(key):
+    """发送 Redis 中到期的消息，只有成功移出待发送集合的实例才会发送."""
+    try:
+        if not redis_client.zrem(REDIS_PENDING_KEY, key):
+            return  # 已由其他实例发送
+        pipe = redis_client.pipeline()
+        pipe.get(f"emby:msg:{key}")
+        pipe.delete(f"emby:msg:{key}")
+        raw, _ = pipe.execute()
+    except redis.RedisError as e:
+        app.logger.error(f"Failed to load pending message {key} from Redis: {e}")
+        return
+    if raw is None:
+        app.logger.warning(f"Pending message {key} expired before it was sent.")
+        return
+    message_data = json.loads(raw)
+    deliver_message(message_data["item_id"], message_data)
+
+
+def recover_redis_messages():
+    """启动时重新调度 Redis 中尚未发送的消息."""
+    try:
+        pending = redis_client.zrange(REDIS_PENDING_KEY, 0, -1, withscores=True)
+    except redis.RedisError as e:
+        app.logger.error(f"Failed to recover pending messages from Redis: {e}")
+        return
+    now = time.time()
+    for key, due in pending:
+        call_later(max(0, due - now), send_redis_message, key)
+    if pending:
+        app.logger.info(f"Recovered {len(pending)} pending messages from Redis.")
+
+
+if redis_client is not None:
+    recover_redis_messages()
+
+
+# 事件类型到处理函数的映射，按完整事件名查找
+EVENT_HANDLERS = {
+    "playback.start": send_message,
+    "playback.stop": send_message,
+    "playback.pause": send_message,
+    "playback.unpause": send_message,
+    "library.new": lib_new,
+    "library.deleted": send_message,
+    "item.markunplayed": marked,
+    "item.markplayed": marked,
+    "system.updateavailable": update,
+    "user.authenticationfailed": send_message,
+    "user.authenticated": send_message,
+    "system.serverrestartrequired": send_message,
+    "plugins.pluginuninstalled": send_message,
+    "plugins.plugininstalled": send_message,
+}
 
 
 def process_event(response, token, send_id, emby_server):
     """处理 Emby 事件，根据事件类型调用相应的处理函数."""
     event = response["Event"]
     app.logger.info(f"Received event: {event}")
-    if "playback.start" in event:
-        send_message(response, token, send_id)
-    elif "playback.stop" in event:
-        send_message(response, token, send_id)
-    elif "playback.pause" in event:
-        send_message(response, token, send_id)
-    elif "playback.unpause" in event:
-        send_message(response, token, send_id)
-    elif "library.new" in event:
-        lib_new(response, token, send_id, emby_server)
-    elif "library.deleted" in event:
-        send_message(response, token, send_id)
-    elif "item.markunplayed" in event:
-        marked(response, token, send_id)
-    elif "item.markplayed" in event:
-        marked(response, token, send_id)
-    elif "system.updateavailable" in event:
-        update(response, token, send_id)
-    elif "user.authenticationfailed" in event:
-        send_message(response, token, send_id)
-    elif "user.authenticated" in event:
-        send_message(response, token, send_id)
-    elif "system.serverrestartrequired" in event:
-        send_message(response, token, send_id)
-    elif "plugins.pluginuninstalled" in event:
-        send_message(response, token, send_id)
-    elif "plugins.plugininstalled" in event:
-        send_message(response, token, send_id)
+    handler = EVENT_HANDLERS.get(event)
+    if handler is lib_new:
+        handler(response, token, send_id, emby_server)
+    elif handler:
+        # 事件名和图标在这里取一次，处理函数不再重复读取
+        handler(response, token, send_id, event, get_icon(event))
     else:
         app.logger.warning(f"Unknown event: {event}")
 
 
+def dedup_key(response):
+    """返回需要去重的媒体库事件的 (事件, 项目 ID)，其他事件返回 None."""
+    event = response.get("Event")
+    item_id = (response.get("Item") or {}).get("Id")
+    if event not in DEDUP_EVENTS or not item_id:
+        return None
+    return (event, item_id)
+
+
+def is_duplicate_event(response):
+    """判断是否为 MESSAGE_DELAY 内重复的媒体库事件，并记录本次事件."""
+    key = dedup_key(response)
+    if key is None:
+        return False
+
+    now = time.monotonic()
+    with _recent_events_lock:
+        seen = _recent_events.get(key)
+        if seen is not None and now - seen < MESSAGE_DELAY:
+            return True
+        _recent_events[key] = now
+        _recent_events.move_to_end(key)
+        if len(_recent_events) > RECENT_EVENTS_MAX:
+            _recent_events.popitem(last=False)
+    return False
+
+
+def forget_event(response):
+    """删除 is_duplicate_event 记录的事件，用于事件最终没有被处理的情况."""
+    key = dedup_key(response)
+    if key is not None:
+        with _recent_events_lock:
+            _recent_events.pop(key, None)
+
+
+def parse_payload():
+    """解析 webhook 的 JSON 数据，优先使用 orjson."""
+    if orjson is not None:
+        try:
+            return orjson.loads(request.get_data())
+        except orjson.JSONDecodeError:
+            pass
+    return request.get_json()
+
+
 @app.route("/webhook", methods=["POST"])
 def webhook():
     """Emby Webhook 入口."""
     if request.method != "POST":
         abort(400)
 
-    response = request.get_json()
+    response = parse_payload()
     app.logger.debug(f"Received JSON: {response}")  # 记录收到的完整 JSON 数据
 
-    config = load_config()
+    config = app.config["EMBY_CFG"]
     if not config:
         app.logger.error("Config load failed, aborting webhook.")
         return "Config error", 500
 
-    token = get_telegram_token(config)
+    token = config["token"]
     if not token:
         app.logger.error("Telegram token error, aborting webhook.")
         return "Telegram token error", 500
 
-    emby_server = get_emby_url(config)
+    emby_server = config["emby_server"]
     if not emby_server:
         app.logger.error("Emby server URL error, aborting webhook.")
         return "Emby server URL error", 500
 
-    admin_ids = get_ids(config, "admins")
+    admin_ids = config["admin_ids"]
     # user_ids = get_ids(config, "users")
     user_ids = None
 
-    if admin_ids:
-        for send_id in admin_ids:
-            process_event(response, token, send_id, emby_server)
-
+    send_ids = list(admin_ids or [])
     if user_ids:
         for send_id in user_ids:
             #  For users, we ONLY process library.new and library.deleted events
             event = response["Event"]
-            if "library.new" in event or "library.deleted" in event:
-                process_event(response, token, send_id, emby_server)
+            if event in ("library.new", "library.deleted"):
+                send_ids.append(send_id)
             else:
                 app.logger.debug(f"Skipping event {event} for user {send_id}")
 
-    return "success", 200
+    if not send_ids:
+        return "success", 200
+
+    # 只在事件确实要入队时才记录，被拒绝的事件重试时不会被当作重复丢弃
+    if is_duplicate_event(response):
+        app.logger.debug(f"Skipping duplicate event {response.get('Event')}")
+        return "dup", 200
+
+    try:
+        _event_queue.put_nowait((response, token, send_ids, emby_server))
+    except queue.Full:
+        forget_event(response)
+        app.logger.error("Event queue is full, rejecting webhook.")
+        return "Too many events", 429
+
+    return "queued", 202
+
+
+def event_worker():
+    """工作线程：从队列中取出事件并发送给对应的用户."""
+    while True:
+        response, token, send_ids, emby_server = _event_queue.get()
+        try:
+            for send_id in send_ids:
+                process_event(response, token, send_id, emby_server)
+        except Exception as e:
+            app.logger.error(f"Error processing queued event: {e}")
+        finally:
+            _event_queue.task_done()
+
+
+for _ in range(EVENT_WORKERS):
+    Thread(target=event_worker, name="event-worker", daemon=True).start()
 
 
 @app.route("/")
@@ -380,9 +731,9 @@ def hello():
 
 
 if __name__ == "__main__":
-    config = load_config()
+    config = app.config["EMBY_CFG"]
     if config:
-        debug = config.get("debug", False)
+        debug = config["data"].get("debug", False)
     else:
         debug = False
 